@@ -1,19 +1,49 @@
 #!/usr/bin/env python3
 
-from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO, UnsupportedOperation
+import copy
+import errno
 import zlib
-import gzip
 import json
 import logging
 import os
 import re
+import shutil
+import signal
+import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
 import time
 
 DEFAULT_BACKUP_ROOT = "/var/backups"
 CONFIG_FILE = "/etc/serverbackup.conf"
+# size of the writes handed to the compressor pipe, and of the chunks used
+# when copying file contents into the tar
+TAR_BUFSIZE = 2 * 1024 * 1024
+# while adding directories, how many of the upcoming files to prefetch, how
+# much of each of them, and with how many threads. Kept to a few MiB in
+# total, so that it can't push the files being added out of the page cache.
+PREFETCH_FILES = 16
+PREFETCH_BYTES = 256 * 1024
+PREFETCH_WORKERS = 4
+# how many databases are dumped at once
+DUMP_WORKERS = 4
+# file extension of the backups for each supported compression
+BACKUP_EXTENSIONS = {"gzip": "tar.gz", "zstd": "tar.zst"}
+# matches the filenames of backups, whatever their name or compression
+BACKUP_FILE_RE = re.compile(r"serverbackup-.+\.tar\.(gz|zst)$")
+# matches backups that are still being written, or were left behind by a run
+# that was killed
+PARTIAL_BACKUP_FILE_RE = re.compile(r"serverbackup-.+\.tar\.(gz|zst)\.partial$")
+# compression level used for each supported compression, unless configured
+DEFAULT_COMPRESSION_LEVELS = {"gzip": 6, "zstd": 3}
+# levels each compressor accepts as-is (gzip has no -0, zstd needs --ultra
+# above 19)
+COMPRESSION_LEVEL_RANGES = {"gzip": range(1, 10), "zstd": range(1, 20)}
 
 # configure logs
 logger = logging.getLogger("serverbackup")
@@ -24,32 +54,293 @@ console_handler.setFormatter(
 )
 logger.addHandler(console_handler)
 
-def delete_local_copies_beyond_max(backup_dir, max_local_copies):
-    backups_to_delete = set()
+# Write-only file object over the compressor's stdin pipe. Pipes can't tell(),
+# which tarfile needs for its non-streaming "w" mode, so the position is
+# tracked here instead.
+class PipeWriter:
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.position = 0
+
+    def write(self, data):
+        self.pipe.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    # Copies count bytes of in_fd, starting at offset, into the pipe with
+    # sendfile(2) so that the data never passes through userspace.
+    def sendfile(self, in_fd, offset, count):
+        self.pipe.flush()
+        out_fd = self.pipe.fileno()
+        remaining = count
+        while remaining > 0:
+            sent = os.sendfile(out_fd, in_fd, offset, remaining)
+            if sent == 0:
+                raise OSError("unexpected end of data")
+            offset += sent
+            remaining -= sent
+        self.position += count
+
+
+# Returns the (offset, length) regions of the first size bytes of fd that
+# hold data, skipping over holes.
+def get_data_regions(fd, size):
+    regions = []
+    offset = 0
+    while offset < size:
+        try:
+            data_start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            # ENXIO means there's no more data after offset
+            if e.errno == errno.ENXIO:
+                break
+            raise
+        if data_start >= size:
+            break
+        data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), size)
+        regions.append((data_start, data_end - data_start))
+        offset = data_end
+    return regions
+
+
+# TarFile that copies member data with sendfile(2) when it comes from a real
+# file, and stores sparse files (VM images, database files...) without their
+# holes using the GNU 1.0 sparse format, like 'tar --sparse' does. Its fileobj
+# must be a PipeWriter.
+class BackupTarFile(tarfile.TarFile):
+    def addfile(self, tarinfo, fileobj=None):
+        try:
+            in_fd = fileobj.fileno()
+        except (AttributeError, UnsupportedOperation):
+            # no file (e.g. a directory) or an in-memory one
+            return super().addfile(tarinfo, fileobj)
+
+        self._check("awx")
+        tarinfo = copy.copy(tarinfo)
+        # Each file is read once, start to end, and never again, so tell the
+        # kernel to read ahead and to not let it crowd out the page cache.
+        os.posix_fadvise(in_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        data_regions = [(fileobj.tell(), tarinfo.size)]
+        sparse_map = b""
+        # a file using fewer blocks than its size has holes in it
+        if (
+            self.format == tarfile.PAX_FORMAT
+            and tarinfo.isreg()
+            and fileobj.tell() == 0
+            and os.fstat(in_fd).st_blocks * 512 < tarinfo.size
+        ):
+            sparse_regions = get_data_regions(in_fd, tarinfo.size)
+            # GNU tar expects the map to reach the end of the file, even if
+            # the file ends with a hole.
+            if not sparse_regions or sum(sparse_regions[-1]) < tarinfo.size:
+                sparse_regions.append((tarinfo.size, 0))
+            sparse_map = f"{len(sparse_regions)}\n".encode() + b"".join(
+                f"{offset}\n{length}\n".encode() for offset, length in sparse_regions
+            )
+            sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+            stored_size = len(sparse_map) + sum(
+                length for offset, length in sparse_regions
+            )
+            # Past 8 GiB the size no longer fits the ustar header and tarfile
+            # would put it in the pax header too, clobbering the real size.
+            if stored_size < 8 ** 11:
+                tarinfo.pax_headers = {
+                    **tarinfo.pax_headers,
+                    "GNU.sparse.major": "1",
+                    "GNU.sparse.minor": "0",
+                    "GNU.sparse.name": tarinfo.name,
+                    "GNU.sparse.realsize": str(tarinfo.size),
+                }
+                tarinfo.size = stored_size
+                data_regions = sparse_regions
+            else:
+                sparse_map = b""
+
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+        self.fileobj.write(sparse_map)
+        for offset, length in data_regions:
+            self.fileobj.sendfile(in_fd, offset, length)
+        os.posix_fadvise(in_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+
+        self.members.append(tarinfo)
+
+
+# Yields path and everything under it, in the same order as tarfile's
+# recursive add(). Symlinks to directories are not followed.
+def walk_backup_paths(path):
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        yield from walk_backup_dir(path)
+
+
+# Yields everything under the directory path, like walk_backup_paths. The
+# type of each entry comes from scandir, which usually costs no extra stat.
+def walk_backup_dir(path):
+    with os.scandir(path) as entries:
+        entries = sorted(entries, key=lambda entry: entry.name)
+    for entry in entries:
+        yield entry.path
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk_backup_dir(entry.path)
+
+
+# Gets the kernel reading the start of a regular file into the page cache,
+# so that it's ready by the time the file is added to the backup. Does
+# nothing once still_upcoming() says the file has already been reached.
+def prefetch_file(path, still_upcoming):
+    if not still_upcoming():
+        return
+    try:
+        if not stat.S_ISREG(os.lstat(path).st_mode):
+            return
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # adding the file will report the problem
+        return
+    try:
+        if still_upcoming():
+            os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+# Yields paths in order, while executor prefetches the PREFETCH_FILES paths
+# that come after the current one.
+def prefetch_ahead(paths, executor):
+    # number of paths handed out so far, shared with the prefetch threads
+    yielded = 0
+    upcoming = deque()
+    for index, path in enumerate(paths):
+        # a prefetch that runs late would be useless, and would undo the
+        # DONTNEED
+        still_upcoming = lambda index=index: index >= yielded
+        upcoming.append((path, executor.submit(prefetch_file, path, still_upcoming)))
+        if len(upcoming) > PREFETCH_FILES:
+            path, prefetch = upcoming.popleft()
+            prefetch.cancel()
+            yielded += 1
+            yield path
+    for path, prefetch in upcoming:
+        prefetch.cancel()
+        yielded += 1
+        yield path
+
+
+# Returns the unix time at which a backup was taken, from its METADATA file.
+def read_backup_timestamp(backup_path):
+    if backup_path.endswith(".tar.zst"):
+        # tarfile can't read zstd, so the zstd binary decompresses it for us
+        try:
+            decompress_proc = subprocess.Popen(
+                ["zstd", "--decompress", "--stdout", "--quiet", backup_path],
+                stdout=subprocess.PIPE,
+            )
+        except OSError as e:
+            # not an OSError, so that the backup isn't taken to be corrupt
+            raise RuntimeError(f"Couldn't run zstd to read {backup_path}") from e
+        try:
+            with tarfile.open(fileobj=decompress_proc.stdout, mode="r|") as f:
+                return read_metadata_timestamp(f)
+        finally:
+            # we usually stop reading long before the end of the archive
+            decompress_proc.kill()
+            decompress_proc.stdout.close()
+            decompress_proc.wait()
+
+    with tarfile.open(backup_path, mode="r|gz") as f:
+        return read_metadata_timestamp(f)
+
+
+# Reads the timestamp out of the METADATA file of a backup opened in streaming
+# mode. METADATA is the first member of the archive (older backups have it
+# last), so we stop reading as soon as it's found.
+def read_metadata_timestamp(backup):
+    for member in backup:
+        if member.name == "METADATA":
+            metadata = json.loads(backup.extractfile(member).read())
+            return metadata["timestamp"]
+    raise KeyError("METADATA not found")
+
+
+# Returns the backups in backup_dir as a list of (timestamp, backup path),
+# along with a set of the paths of backups that couldn't be read.
+def find_backups(backup_dir, name):
+    backups = []
+    corrupt_backups = set()
+    # When the filename carries the timestamp we use it directly, so that the
+    # archive doesn't have to be decompressed just to find the METADATA file.
+    filename_timestamp_re = re.compile(
+        rf"serverbackup-{re.escape(name)}-(\d+)\.tar\.(gz|zst)$"
+    )
+    with os.scandir(backup_dir) as entries:
+        entries = list(entries)
+    backup_entries = [entry for entry in entries if BACKUP_FILE_RE.match(entry.name)]
+
+    # Runs never overlap, so any partial backup found here is from a run that
+    # was killed before it could clean up after itself.
+    for entry in entries:
+        if PARTIAL_BACKUP_FILE_RE.match(entry.name):
+            logger.warning(f"Backup {entry.name} incomplete - marking for deletion")
+            corrupt_backups.add(entry.path)
+
+    for backup_entry in backup_entries:
+        filename_match = filename_timestamp_re.match(backup_entry.name)
+        if filename_match:
+            backups.append((int(filename_match.group(1)), backup_entry.path))
+            continue
+
+        try:
+            backup_timestamp = read_backup_timestamp(backup_entry.path)
+        except (KeyError, OSError, EOFError, zlib.error, tarfile.TarError):
+            logger.warning(f"Backup {backup_entry.name} corrupt - marking for deletion")
+            corrupt_backups.add(backup_entry.path)
+            continue
+        backups.append((backup_timestamp, backup_entry.path))
+    return backups, corrupt_backups
+
+
+# Returns how many days old, as of now, a backup with the given timestamp is.
+# we use '23 hours' as a day instead of 24 so that if retention_days
+# is set to '1' and this script runs daily, the old backups are
+# guaranteed to be cleared.
+def get_days_old(backup_timestamp, now):
+    return int((now - backup_timestamp) / (60 * 60 * 23))
+
+
+# Deletes backups along with their encrypted copies, if any.
+def delete_backups(backups_to_delete):
+    for backup_to_delete in backups_to_delete:
+        logger.debug(f"Deleting backup {backup_to_delete}")
+        os.remove(backup_to_delete)
+        encrypted_backup = f"{backup_to_delete}.gpg"
+        try:
+            os.remove(encrypted_backup)
+            logger.debug(f"Deleted encrypted backup {encrypted_backup}")
+        except FileNotFoundError:
+            pass
+
+
+def delete_local_copies_beyond_max(backup_dir, name, max_local_copies):
     assert max_local_copies > 0, "max_local_copies must be greater than 0"
     logger.debug(f"Cleaning up old local backups in {backup_dir}")
-    backup_paths_with_age = [] # list of tuples (days old, backup path)
-    backup_files = [
-        f
-        for f in os.listdir(backup_dir)
-        if f.startswith("serverbackup-") and f.endswith(".tar.gz")
+    backups, backups_to_delete = find_backups(backup_dir, name)
+    now = time.time()
+    backup_paths_with_age = [
+        (get_days_old(backup_timestamp, now), backup_path)
+        for (backup_timestamp, backup_path) in backups
     ]
-    for backup_file in backup_files:
-        backup_path = os.path.join(backup_dir, backup_file)
-        with tarfile.open(backup_path, mode="r:gz") as f:
-            try:
-                metadata = json.loads(f.extractfile("METADATA").read())
-                backup_timestamp = metadata["timestamp"]
-            except (KeyError, OSError, EOFError, zlib.error):
-                logger.warning(f"Backup {backup_file} corrupt - marking for deletion")
-                backups_to_delete.add(backup_path)
-                continue
-
-            # we use '23 hours' as a day instead of 24 so that if retention_days
-            # is set to '1' and this script runs daily, the old backups are
-            # guaranteed to be cleared.
-            days_old = int((time.time() - backup_timestamp) / (60 * 60 * 23))
-            backup_paths_with_age.append((days_old, backup_path))
 
     backup_paths_sorted_by_age = [
         backup_path
@@ -65,17 +356,183 @@ def delete_local_copies_beyond_max(backup_dir, max_local_copies):
     )
     backups_to_delete.update(backup_paths_beyond_max_copies)
 
-    for backup_to_delete in backups_to_delete:
-        logger.debug(f"Deleting backup {backup_to_delete}")
-        os.remove(backup_to_delete)
-        encrypted_backup = f"{backup_to_delete}.gpg"
-        if os.path.isfile(encrypted_backup):
-            logger.debug(f"Deleting encrypted backup {encrypted_backup}")
-            os.remove(encrypted_backup)
+    delete_backups(backups_to_delete)
+
+
+# Waits for a process started with Popen, raising CalledProcessError if it
+# failed, the same as subprocess.run(..., check=True) would.
+def wait_checked(proc):
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
 
+# Starts gpg symmetrically encrypting backup_path into output ("-" for
+# stdout). The passphrase is written to gpg's pipe only once gpg is running,
+# so that a long passphrase can't fill the pipe and block us.
+def start_encryption(backup_path, output, encryption_password, **popen_kwargs):
+    keypipe_r, keypipe_w = os.pipe()
+    with open(keypipe_w, "wb") as keypipe:
+        try:
+            gpg_proc = subprocess.Popen(
+                [
+                    "gpg",
+                    "--pinentry-mode",
+                    "loopback",
+                    "--passphrase-fd",
+                    str(keypipe_r),
+                    "--quiet",
+                    "--batch",
+                    "--output",
+                    output,
+                    "--symmetric",
+                    backup_path,
+                ],
+                pass_fds=(keypipe_r,),
+                **popen_kwargs,
+            )
+        finally:
+            os.close(keypipe_r)
+        keypipe.write(f"{encryption_password}\n".encode())
+    return gpg_proc
+
+
+# Dumps a database into a temporary file in dump_dir, returned rewound to the
+# start. mysqldump writes straight to the file so that the dump is never held
+# in memory, no matter how large the database is. dump_dir should be on disk:
+# /tmp is often a tmpfs, which would hold the whole dump in RAM after all.
+def dump_database(database, user, password, dump_dir):
+    logger.debug(f"Dumping database {database}")
+    dump = tempfile.TemporaryFile(dir=dump_dir)
+    try:
+        subprocess.run(
+            ["mysqldump", database, f"--user={user}", f"--password={password}"],
+            stdout=dump,
+            check=True,
+        )
+    except BaseException:
+        dump.close()
+        raise
+    dump.seek(0)
+    return dump
+
+
+# Closes the dump returned by a finished dump_database future, if any.
+def close_dump(dump_future):
+    if not dump_future.cancelled() and dump_future.exception() is None:
+        dump_future.result().close()
+
+
+# Dumps databases into dump_dir and adds the dumps to backup, in order. Up to
+# DUMP_WORKERS databases are dumped at once, ahead of the one being added, so
+# at most that many dumps are on disk at any time.
+def add_database_dumps(backup, databases, dump_dir):
+    with ThreadPoolExecutor(max_workers=DUMP_WORKERS) as executor:
+        dump_futures = deque()
+        try:
+            for database, user, password in databases:
+                dump_futures.append(
+                    (
+                        database,
+                        executor.submit(
+                            dump_database, database, user, password, dump_dir
+                        ),
+                    )
+                )
+                if len(dump_futures) >= DUMP_WORKERS:
+                    add_database_dump(backup, *dump_futures.popleft())
+            while dump_futures:
+                add_database_dump(backup, *dump_futures.popleft())
+        except BaseException:
+            # Don't start any more dumps, and close the ones that were or
+            # will be made, rather than leaving them to the garbage collector.
+            for database, dump_future in dump_futures:
+                dump_future.cancel()
+                dump_future.add_done_callback(close_dump)
+            raise
+
+
+def add_database_dump(backup, database, dump_future):
+    with dump_future.result() as dump:
+        logger.debug(f"Adding database dump {database}")
+        tarinfo = tarfile.TarInfo(name=f"{database}.sql")
+        tarinfo.size = os.fstat(dump.fileno()).st_size
+        backup.addfile(tarinfo, dump)
+
+
+# Writes the backup archive to backup_path, compressing it with
+# compress_args. If anything fails the compressor is killed and the exception
+# raised, leaving whatever was written so far at backup_path.
+def write_backup(backup_path, compress_args, timestamp, databases, dirs_to_backup):
+    with open(backup_path, "wb") as backup_file:
+        compress_proc = subprocess.Popen(
+            compress_args,
+            stdin=subprocess.PIPE,
+            stdout=backup_file,
+            bufsize=TAR_BUFSIZE,
+        )
+    with compress_proc:
+        try:
+            # name is only used so that tarfile skips the backup itself,
+            # should one of the directories contain backup_root
+            backup = BackupTarFile(
+                name=backup_path,
+                fileobj=PipeWriter(compress_proc.stdin),
+                mode="w",
+                copybufsize=TAR_BUFSIZE,
+            )
+            # Step 1: Create a METADATA file. It is the first member so that
+            # cleanup can read it without decompressing the rest of the archive.
+            logger.debug("Adding METADATA")
+            metadata = {}
+            metadata["timestamp"] = timestamp
+            metadata_data = json.dumps(metadata, separators=(",", ":")).encode(
+                "utf-8"
+            )
+            # pad with spaces (still valid JSON) so METADATA fills whole blocks
+            metadata_data += b" " * (-len(metadata_data) % tarfile.BLOCKSIZE)
+            metadata_tarinfo = tarfile.TarInfo(name="METADATA")
+            metadata_tarinfo.size = len(metadata_data)
+            backup.addfile(metadata_tarinfo, BytesIO(metadata_data))
+
+            # Step 2: Dump database and add it to the backup tar
+            # The dumps are kept next to the backup, which is on disk.
+            add_database_dumps(backup, databases, os.path.dirname(backup_path))
+
+            # Step 3: Add all files in DIRS_TO_BACKUP
+            # The tar can only be written from one thread, so other threads
+            # open the upcoming files ahead of it instead, overlapping disk
+            # reads with compression.
+            with ThreadPoolExecutor(max_workers=PREFETCH_WORKERS) as executor:
+                for dir_to_backup in dirs_to_backup:
+                    logger.debug(f"Adding directory {dir_to_backup}")
+                    paths = walk_backup_paths(dir_to_backup)
+                    for path in prefetch_ahead(paths, executor):
+                        backup.add(path, recursive=False)
+
+            backup.close()
+        except BaseException:
+            compress_proc.kill()
+            # drop whatever is still buffered for it, so that the real error
+            # isn't hidden behind a BrokenPipeError
+            try:
+                compress_proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            raise
+    wait_checked(compress_proc)
+
+
+# SIGTERM handler, turning the signal into an exception so that an
+# interrupted backup is cleaned up the same as a failed one.
+def exit_on_sigterm(signum, frame):
+    raise SystemExit(128 + signum)
+
 
 def main() -> int:
+    # systemd stops the service (on 'systemctl stop', a timeout or shutdown)
+    # with SIGTERM
+    signal.signal(signal.SIGTERM, exit_on_sigterm)
+
     logger.debug("Parsing config file")
     with open(CONFIG_FILE, "r") as f:
         config = json.load(f)
@@ -86,14 +543,32 @@ def main() -> int:
     dirs_to_backup = config.get("directories") or []
     s3config = config.get("s3config")
     s3bucket = config.get("s3bucket")
+    s3_multipart_chunk_size_mb = config.get("s3_multipart_chunk_size_mb")
     retention_days = config.get("retention_days")
     max_local_copies = config.get("max_local_copies")
     encryption_password = config.get("encryption_password")
     keep_encrypted_backup_after_upload = config.get("keep_encrypted_backup_after_upload", False)
     backup_root = config.get("backup_root", DEFAULT_BACKUP_ROOT)
     include_timestamp_in_filename = config.get("include_timestamp_in_filename", True)
+    compression = config.get("compression", "gzip")
+    compression_level = config.get("compression_level")
 
     # config validation
+    if compression not in BACKUP_EXTENSIONS:
+        raise ValueError(
+            f"compression must be one of {', '.join(BACKUP_EXTENSIONS)}"
+        )
+    if compression_level is None:
+        compression_level = DEFAULT_COMPRESSION_LEVELS[compression]
+    level_range = COMPRESSION_LEVEL_RANGES[compression]
+    if (
+        type(compression_level) is not int
+        or compression_level not in level_range
+    ):
+        raise ValueError(
+            f"compression_level for {compression} must be an integer from "
+            f"{level_range.start} to {level_range.stop - 1}"
+        )
     if not include_timestamp_in_filename and max_local_copies > 1:
         raise ValueError("Timestamp may only be toggled off if max_local_copies is 1")
 
@@ -107,55 +582,31 @@ def main() -> int:
     # For backwards incompatibility, the max_local_copies flow is not invoked
     # unless retention_days is absent.
     if retention_days is not None:
-        backups_to_delete = set()
         logger.warning("retention_days is DEPRECATED. Please switch to max_local_copies")
 
         assert retention_days > 0, "retention_days must be greater than 0"
         logger.debug(f"Cleaning up old backups in {backup_dir}")
-        backup_files = [
-            f
-            for f in os.listdir(backup_dir)
-            if f.startswith("serverbackup-") and f.endswith(".tar.gz")
-        ]
-        for backup_file in backup_files:
-            backup_path = os.path.join(backup_dir, backup_file)
-            with tarfile.open(backup_path, mode="r:gz") as f:
-                try:
-                    metadata = json.loads(f.extractfile("METADATA").read())
-                    backup_timestamp = metadata["timestamp"]
-                except (KeyError, OSError, EOFError, zlib.error):
-                    logger.warning(
-                        f"Backup {backup_file} corrupt - marking for deletion"
-                    )
-                    backups_to_delete.add(backup_path)
-                    continue
-
-                # we use '23 hours' as a day instead of 24 so that if retention_days
-                # is set to '1' and this script runs daily, the old backups are
-                # guaranteed to be cleared.
-                days_old = int((time.time() - backup_timestamp) / (60 * 60 * 23))
-                if days_old > retention_days:
-                    logger.debug(
-                        f"Backup {backup_file} is {days_old} days old - marking for deletion"
-                    )
-                    backups_to_delete.add(backup_path)
+        backups, backups_to_delete = find_backups(backup_dir, name)
+        now = time.time()
+        for backup_timestamp, backup_path in backups:
+            days_old = get_days_old(backup_timestamp, now)
+            if days_old > retention_days:
+                logger.debug(
+                    f"Backup {os.path.basename(backup_path)} is {days_old} days old - marking for deletion"
+                )
+                backups_to_delete.add(backup_path)
 
-        for backup_to_delete in backups_to_delete:
-            logger.debug(f"Deleting backup {backup_to_delete}")
-            os.remove(backup_to_delete)
-            encrypted_backup = f"{backup_to_delete}.gpg"
-            if os.path.isfile(encrypted_backup):
-                logger.debug(f"Deleting encrypted backup {encrypted_backup}")
-                os.remove(encrypted_backup)
+        delete_backups(backups_to_delete)
 
 
     elif max_local_copies is not None:
-        delete_local_copies_beyond_max(backup_dir, max_local_copies)
+        delete_local_copies_beyond_max(backup_dir, name, max_local_copies)
 
     # start backup process
     timestamp = int(time.time())
     timestamp_str = f"-{timestamp}" if include_timestamp_in_filename else ""
-    backup_path = f"{backup_dir}/serverbackup-{name}{timestamp_str}.tar.gz"
+    extension = BACKUP_EXTENSIONS[compression]
+    backup_path = f"{backup_dir}/serverbackup-{name}{timestamp_str}.{extension}"
 
     # corner case! if user only wants one backup and doesnt put the timestamp
     # in the file name, then the backup might already exist. if so, we delete it.
@@ -170,87 +621,97 @@ def main() -> int:
 
 
     logger.debug(f"Starting backup of {name} to {backup_path}")
-    backup = tarfile.open(backup_path, mode="w:gz")
-    # Step 1: Dump database and add it to the backup tar
-    for database, user, password in databases:
-        logger.debug(f"Dumping database {database}")
-        dump_proc = subprocess.run(
-            ["mysqldump", database, f"--user={user}", f"--password={password}"],
-            stdout=subprocess.PIPE,
-            check=True,
+    # Compression is done by an external process (pigz or zstd, so that all
+    # cores are used) and the tar is streamed into it uncompressed.
+    if compression == "zstd":
+        compress_args = ["zstd", "-T0", f"-{compression_level}", "--quiet", "--stdout"]
+    else:
+        compressor = "pigz" if shutil.which("pigz") else "gzip"
+        compress_args = [compressor, f"-{compression_level}", "-c"]
+    logger.debug(f"Compressing with {compress_args[0]}")
+    # The backup is written under a temporary name that cleanup doesn't
+    # recognise, and only renamed once it's complete, so that a failed run
+    # can't leave a truncated backup that looks like a good one.
+    partial_path = f"{backup_path}.partial"
+    try:
+        write_backup(
+            partial_path, compress_args, timestamp, databases, dirs_to_backup
         )
-        dump = dump_proc.stdout
-        tarinfo = tarfile.TarInfo(name=f"{database}.sql")
-        tarinfo.size = len(dump)
-        backup.addfile(tarinfo, BytesIO(dump))
-
-    # Step 2: Add all files in DIRS_TO_BACKUP
-    for dir_to_backup in dirs_to_backup:
-        logger.debug(f"Adding directory {dir_to_backup}")
-        backup.add(dir_to_backup, recursive=True)
-
-    # Step 3: Create a METADATA file
-    logger.debug("Adding METADATA")
-    metadata = {}
-    metadata["timestamp"] = timestamp
-    metadata_data = json.dumps(metadata).encode("utf-8")
-    metadata_tarinfo = tarfile.TarInfo(name="METADATA")
-    metadata_tarinfo.size = len(metadata_data)
-    backup.addfile(metadata_tarinfo, BytesIO(metadata_data))
-
-    backup.close()
+    except BaseException:
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+        raise
+    os.rename(partial_path, backup_path)
 
     # Step 4: If config has data, upload to s3 using s3cmd
     if s3config and s3bucket:
-        encrypted_path = None
+        s3cmd = ["s3cmd", "--config", s3config]
+        s3cmd_put = s3cmd + ["put"]
+        if s3_multipart_chunk_size_mb is not None:
+            s3cmd_put.append(
+                f"--multipart-chunk-size-mb={s3_multipart_chunk_size_mb}"
+            )
         if encryption_password:
             logger.debug("Encrypting before uploading to s3")
-            encrypted_path = f"{backup_path}.gpg"
 
-            keypipe_r, keypipe_w = os.pipe()
-            os.write(keypipe_w, f"{encryption_password}\n".encode())
-            os.close(keypipe_w)
+        if encryption_password and keep_encrypted_backup_after_upload:
+            encrypted_path = f"{backup_path}.gpg"
+            wait_checked(
+                start_encryption(backup_path, encrypted_path, encryption_password)
+            )
 
+            logger.debug("Uploading to s3")
             subprocess.run(
-                [
-                    "gpg",
-                    "--passphrase-fd",
-                    str(keypipe_r),
-                    "--quiet",
-                    "--batch",
-                    "--output",
-                    encrypted_path,
-                    "--symmetric",
-                    backup_path,
-                ],
-                pass_fds=(keypipe_r,),
+                s3cmd_put + [encrypted_path, f"s3://{s3bucket}"],
+                check=True,
+            )
+        elif encryption_password:
+            # The encrypted backup isn't kept, so rather than writing it to
+            # disk and reading it back, gpg's output is piped into s3cmd.
+            # s3cmd can't tell a failed gpg from a finished one, so the upload
+            # goes to a temporary key and is only moved into place once both
+            # have succeeded.
+            logger.debug("Uploading to s3")
+            upload_key = f"s3://{s3bucket}/{os.path.basename(backup_path)}.gpg"
+            partial_upload_key = f"{upload_key}.partial"
+            gpg_proc = start_encryption(
+                backup_path, "-", encryption_password, stdout=subprocess.PIPE
+            )
+            s3cmd_proc = subprocess.Popen(
+                s3cmd_put + ["-", partial_upload_key],
+                stdin=gpg_proc.stdout,
+            )
+            gpg_proc.stdout.close()
+            gpg_proc.wait()
+            s3cmd_proc.wait()
+            try:
+                # s3cmd first: if it fails, gpg fails too on the broken pipe
+                wait_checked(s3cmd_proc)
+                wait_checked(gpg_proc)
+            except subprocess.CalledProcessError:
+                logger.error(f"Upload failed - deleting {partial_upload_key}")
+                subprocess.run(s3cmd + ["del", partial_upload_key])
+                raise
+            subprocess.run(
+                s3cmd + ["mv", partial_upload_key, upload_key],
+                check=True,
+            )
+        else:
+            logger.debug("Uploading to s3")
+            subprocess.run(
+                s3cmd_put + [backup_path, f"s3://{s3bucket}"],
                 check=True,
             )
-            os.close(keypipe_r)
-
-        logger.debug("Uploading to s3")
-        subprocess.run(
-            [
-                "s3cmd",
-                "--config",
-                s3config,
-                "put",
-                encrypted_path or backup_path,
-                f"s3://{s3bucket}",
-            ],
-            check=True,
-        )
 
         logger.debug("Upload complete!")
-        if encrypted_path and not keep_encrypted_backup_after_upload:
-            logger.debug("Deleting encrypted backup")
-            os.remove(encrypted_path)
 
     # Since we guarantee "at most max local copies", we need to perform
     # one more check after backup - if we've gone above the max, we probably
     # need to perform another deletion.
     if retention_days is None and max_local_copies is not None:
-        delete_local_copies_beyond_max(backup_dir, max_local_copies)
+        delete_local_copies_beyond_max(backup_dir, name, max_local_copies)
 
 
 if __name__ == "__main__":